@@ -541,7 +541,7 @@ def api_key_test(tracker: TR, key: str):
         msg_box.show()
     else:
         from gazelle.api_classes import sleeve, RequestFailure
-        api = sleeve(tracker, key=key)
+        api = sleeve(tracker, cached=False, key=key)  # fresh session, the key has to be checked for real
         try:
             account_info = api.account_info
         except RequestFailure as e:
@@ -1,13 +1,24 @@
 import re
 import time
-import base64
 import logging
+import threading
 from hashlib import sha256
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from http.cookiejar import LWPCookieJar, LoadError
 
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+try:
+    from orjson import loads as json_loads, JSONDecodeError
+except ImportError:
+    from json import loads as json_loads, JSONDecodeError
+
 import requests
-from requests.exceptions import JSONDecodeError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from lib import tp_text
 from gazelle.torrent_info import TorrentInfo
@@ -19,28 +30,68 @@ class RequestFailure(Exception):
 
 report = logging.getLogger('tr.api')
 
+AUTHKEY_REGEX = re.compile(r"authkey=([a-zA-Z0-9]+)")
+PASSKEY_REGEX = re.compile(r"passkey=([a-zA-Z0-9]+)")
+USERID_REGEX = re.compile(r"user(?:id)?=(\d+)")
+UPL_WARNING_REGEX = re.compile(r'<p style="color: red;text-align:center;">(.+?)</p>')
+
 
 class BaseApi:
+    # actions that have their own .php page, all others go through ajax.php
+    page_actions = ()
+    # shared by all instances of a tracker so they can't exceed its request limit together
+    # entries are [completion time], [None] while the request is in flight
+    _req_history = {t: deque(maxlen=t.req_limit) for t in TR}
+    _req_conds = {t: threading.Condition() for t in TR}
+
     def __init__(self, tracker: TR, **kwargs):
         assert tracker in TR, 'Unknown Tracker'  # TODO uitext
         self.tr = tracker
         self.url = self.tr.site
+        self._endpoints = {sfx: f'{self.url}{sfx}.php' for sfx in ('ajax', *self.page_actions)}
         self.session = requests.Session()
-        self.last_x_reqs = deque([.0], maxlen=self.tr.req_limit)
+        # connection errors only: status/read retries would send requests the rate limiter never saw
+        retry = Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.last_x_reqs = self._req_history[self.tr]
         self.authenticate(**kwargs)
         self._account_info = None
-
-    def _rate_limit(self):
-        t = time.time() - self.last_x_reqs[0]
-        if t <= 10:
-            time.sleep(10 - t)
+        self._announce = None
+
+    def _rate_limit(self) -> list:
+        cond = self._req_conds[self.tr]
+        with cond:
+            while len(self.last_x_reqs) == self.tr.req_limit:
+                oldest = self.last_x_reqs[0][0]
+                if oldest is None:
+                    cond.wait()
+                    continue
+                t = time.monotonic() - oldest
+                if t > 10:
+                    break
+                cond.wait(10 - t)
+
+            slot = [None]
+            self.last_x_reqs.append(slot)
+            return slot
+
+    def _req_done(self, slot: list):
+        cond = self._req_conds[self.tr]
+        with cond:
+            slot[0] = time.monotonic()
+            cond.notify_all()
 
     def authenticate(self, _):
         return NotImplementedError
 
     @property
     def announce(self):
-        return self.tr.tracker.format(**self.account_info)
+        if self._announce is None:
+            self._announce = self.tr.tracker.format(**self.account_info)
+
+        return self._announce
 
     @ property
     def account_info(self):
@@ -53,22 +104,29 @@ class BaseApi:
         r = self.request('index')
         return {k: r[k] for k in ('authkey', 'passkey', 'id', 'username')}
 
-    def request(self, url_suffix: str, data=None, files=None, **kwargs) -> dict | bytes:
-        url = self.url + url_suffix + '.php'
+    def request(self, action: str, data=None, files=None, **kwargs) -> dict | bytes:
+        if action in self.page_actions:
+            url_suffix = action
+        else:
+            url_suffix = 'ajax'
+            kwargs.update(action=action)
+
+        url = self._endpoints[url_suffix]
         report.debug(f'{self.tr.name} {url_suffix} {kwargs}')
         req_method = 'POST' if data or files else 'GET'
 
-        self._rate_limit()
-        r = self.session.request(req_method, url, params=kwargs, data=data, files=files)
-        self.last_x_reqs.append(time.time())
+        slot = self._rate_limit()
+        try:
+            r = self.session.request(req_method, url, params=kwargs, data=data, files=files)
+        finally:
+            self._req_done(slot)
 
+        if 'application/x-bittorrent' in r.headers.get('content-type', ''):
+            return r.content
         try:
-            r_dict = r.json()
+            r_dict = json_loads(r.content)
         except JSONDecodeError:
-            if 'application/x-bittorrent' in r.headers['content-type']:
-                return r.content
-            else:
-                raise RequestFailure(f'no json, no torrent. {r.status_code}')
+            raise RequestFailure(f'no json, no torrent. {r.status_code}')
         else:
             status = r_dict.get('status')
             if status == 'success':
@@ -100,22 +158,19 @@ class KeyApi(BaseApi):
         key = kwargs['key']
         self.session.headers.update({"Authorization": key})
 
-    def request(self, action: str, data=None, files=None, **kwargs):
-        kwargs.update(action=action)
-        return super().request('ajax', data=data, files=files, **kwargs)
-
     def upl_response_handler(self, r):
         raise NotImplementedError
 
     def get_riplog(self, tor_id: int, log_id: int):
         r: dict = self.request('riplog', id=tor_id, logid=log_id)
-        log_bytes = base64.b64decode(r['log'])
-        log_checksum = sha256(log_bytes).hexdigest()
-        assert log_checksum == r['log_sha256']
+        log_bytes = b64decode(r['log'])
+        log_checksum = sha256(log_bytes, usedforsecurity=False).digest()
+        assert log_checksum == bytes.fromhex(r['log_sha256'])
         return log_bytes
 
 
 class CookieApi(BaseApi):
+    page_actions = ('upload', 'login')  # TODO download?
 
     def authenticate(self, **kwargs):
         self.session.cookies = LWPCookieJar(f'cookie{self.tr.name}.txt')
@@ -126,12 +181,17 @@ class CookieApi(BaseApi):
         jar = self.session.cookies
         try:
             jar.load()
-            session_cookie = [c for c in jar if c.name == "session"][0]
-            assert not session_cookie.is_expired()
-        except (FileNotFoundError, LoadError, IndexError, AssertionError):
+        except (FileNotFoundError, LoadError):
             return False
 
-        return True
+        # jar._cookies is {domain: {path: {name: Cookie}}}
+        for domain in jar._cookies.values():
+            for path in domain.values():
+                session_cookie = path.get('session')
+                if session_cookie is not None:
+                    return not session_cookie.is_expired()
+
+        return False
 
     def _login(self, **kwargs):
         username, password = kwargs['f']()
@@ -140,25 +200,16 @@ class CookieApi(BaseApi):
                 'keeplogged': '1'}
         self.session.cookies.clear()
         self.request('login', data=data)
-        assert [c for c in self.session.cookies if c.name == 'session']
+        assert any(c.name == 'session' for c in self.session.cookies)
         self.session.cookies.save()
 
-    def request(self, action: str, data=None, files=None, **kwargs):
-        if action in ('upload', 'login'):  # TODO download?
-            url_addon = action
-        else:
-            url_addon = 'ajax'
-            kwargs.update(action=action)
-
-        return super().request(url_addon, data=data, files=files, **kwargs)
-
     def _uploader(self, data: dict, files: list):
         data['submit'] = True
         super()._uploader(data, files)
 
     def upl_response_handler(self, r: requests.Response):
         if 'torrents.php' not in r.url:
-            warning = re.search(r'<p style="color: red;text-align:center;">(.+?)</p>', r.text)
+            warning = UPL_WARNING_REGEX.search(r.text)
             raise RequestFailure(f"{warning.group(1) if warning else r.url}")
         return r.url  # TODO re torrentid from url and return
 
@@ -168,9 +219,9 @@ class HtmlApi(CookieApi):
     def get_account_info(self):
         r = self.session.get(self.url + 'index.php')
         return {
-            'authkey': re.search(r"authkey=(.+?)[^a-zA-Z0-9]", r.text).group(1),
-            'passkey': re.search(r"passkey=(.+?)[^a-zA-Z0-9]", r.text).group(1),
-            'id': int(re.search(r"useri?d?=(.+?)[^0-9]", r.text).group(1))
+            'authkey': AUTHKEY_REGEX.search(r.text).group(1),
+            'passkey': PASSKEY_REGEX.search(r.text).group(1),
+            'id': int(USERID_REGEX.search(r.text).group(1))
         }
 
     def torrent_info(self, **kwargs):
@@ -211,9 +262,40 @@ class OpsApi(KeyApi):
 
         return torrent_id, group_id, self.url + f"torrents.php?id={group_id}&torrentid={torrent_id}"
 
-def sleeve(trckr: TR, **kwargs) -> RedApi | OpsApi:
+# {tracker: (kwargs, api)}, one live instance per tracker
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def sleeve(trckr: TR, cached=True, **kwargs) -> RedApi | OpsApi:
     api_map = {
         TR.RED: RedApi,
         TR.OPS: OpsApi
     }
-    return api_map[trckr](**kwargs)
+    if not cached:
+        return api_map[trckr](**kwargs)
+
+    inst_kwargs = sorted(kwargs.items())
+    with _instances_lock:
+        cached = _instances.get(trckr)
+        # a changed/tested api key replaces the old instance instead of reusing it
+        if cached is None or cached[0] != inst_kwargs:
+            cached = _instances[trckr] = inst_kwargs, api_map[trckr](**kwargs)
+
+    return cached[1]
+
+
+def _warm_sleeve(trckr: TR, key: str) -> RedApi | OpsApi:
+    api = sleeve(trckr, key=key)
+    if key:
+        try:
+            api.account_info
+        except (RequestFailure, requests.RequestException) as e:
+            # not fatal here, account_info is fetched again and raises on first real use
+            report.warning(f'{trckr.name} account info prefetch failed: {e}')
+    return api
+
+
+def sleeve_many(key_dict: dict[TR, str]) -> dict[TR, RedApi | OpsApi]:
+    with ThreadPoolExecutor(max_workers=len(key_dict)) as ex:
+        return dict(zip(key_dict, ex.map(_warm_sleeve, key_dict, key_dict.values())))
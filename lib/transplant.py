@@ -8,7 +8,7 @@ from bcoding import bencode, bdecode
 
 from gazelle import upload
 from gazelle.tracker_data import TR, Encoding, BAD_RED_ENCODINGS, ArtistType
-from gazelle.api_classes import sleeve, BaseApi, OpsApi
+from gazelle.api_classes import sleeve_many, BaseApi, OpsApi
 from gazelle.torrent_info import TorrentInfo
 from lib import utils, tp_text
 from lib.info_2_upl import TorInfo2UplData
@@ -108,7 +108,7 @@ class Transplanter:
                  save_dtors=False, del_dtors=False, file_check=True, rel_descr_templ=None, rel_descr_own_templ=None,
                  add_src_descr=True, src_descr_templ=None, img_rehost=False, whitelist=None, post_compare=False):
 
-        self.api_map = {trckr: sleeve(trckr, key=key_dict[trckr]) for trckr in TR}
+        self.api_map = sleeve_many({trckr: key_dict[trckr] for trckr in TR})
         self.data_dir: Path = data_dir
         self.deep_search = deep_search
         self.deep_search_level = deep_search_level